@@ -1,17 +1,24 @@
 import io
+import gzip
 import csv
-import json
 import os
+import hashlib
 import time
-import uuid
+import itertools
+import random
 import asyncio
 import logging
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+import threading
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Response
 from fastapi.responses import JSONResponse, StreamingResponse
-import PyPDF2
+from starlette.background import BackgroundTask
+import pymupdf
 import docx
+import orjson
 import uvicorn
 import httpx
+from cachetools import TTLCache
 
 # For testing only: set environment variables directly.
 
@@ -19,30 +26,92 @@ import httpx
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise RuntimeError("Please set the OPENAI_API_KEY environment variable.")
+# Scoring is a structured task a small model handles well; criteria extraction stays on the larger one.
+MODEL_CRITERIA = os.getenv("OPENAI_CRITERIA_MODEL", "gpt-4o")
+MODEL_SCORE = os.getenv("OPENAI_SCORE_MODEL", "gpt-4o-mini")
+MODEL_SCORE_PRECISE = os.getenv("OPENAI_SCORE_PRECISE_MODEL", "gpt-4o")  # Used when precision is requested
+# Upper bound on max_tokens per scoring request; must not exceed the output cap of either scoring model.
+SCORING_MAX_TOKENS = int(os.getenv("OPENAI_SCORE_MAX_TOKENS", "4096"))
+# Gzip request bodies sent to OpenAI. Off by default since request compression isn't part of OpenAI's documented API.
+OPENAI_GZIP_REQUESTS = os.getenv("OPENAI_GZIP_REQUESTS", "").lower() in ("1", "true", "yes")
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("app")
 
+OPENAI_BASE_URL = "https://api.openai.com"
+SCORING_CONCURRENCY = int(os.getenv("SCORING_CONCURRENCY", "20"))  # Max in-flight OpenAI scoring calls, keeps bursts under the RPM limit.
+SCORING_TIMEOUT = 90  # seconds
+SCORING_CHUNK_SIZE = 5  # Resumes fused into one OpenAI request; keeps the reply well within max_tokens.
+BATCH_POLL_INITIAL = 2  # seconds; doubles after every poll
+BATCH_POLL_MAX = 60  # seconds
+BATCH_TIMEOUT = 3600  # seconds
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024  # Largest accepted resume/job description file
+UPLOAD_CONCURRENCY = 4  # Uploads read into memory and parsed at once; peak memory is about this x MAX_UPLOAD_BYTES
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)  # Transient OpenAI responses worth retrying
+RETRY_MAX_ATTEMPTS = 5
+RETRY_WAIT_MIN = 1  # seconds
+RETRY_WAIT_MAX = 30  # seconds
+
+# ------------------ Lifespan: Shared HTTP Client ------------------
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One long-lived client so every OpenAI call reuses pooled keep-alive connections.
+    # HTTP/2 (requires httpx[http2]) multiplexes the concurrent scoring calls over few connections.
+    app.state.http_client = httpx.AsyncClient(
+        base_url=OPENAI_BASE_URL,
+        headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+        http2=True,
+        timeout=httpx.Timeout(connect=5.0, read=60.0, write=10.0, pool=5.0),
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=256, keepalive_expiry=60)
+    )
+    # Pre-warm the connection so the first user request doesn't pay the TCP+TLS handshake.
+    try:
+        response = await app.state.http_client.get("/v1/models")
+        logger.info(f"OpenAI connection warmed up, status: {response.status_code}")
+    except Exception as e:
+        logger.warning(f"OpenAI connection warm-up failed: {e}")
+    yield
+    await app.state.http_client.aclose()
+
 app = FastAPI(
     title="Resume Ranking API",
-    description="Extract ranking criteria and score resumes using an in‑memory queue. See /docs for interactive documentation.",
-    version="1.0"
+    description="Extract ranking criteria and score resumes concurrently. See /docs for interactive documentation.",
+    version="1.0",
+    lifespan=lifespan
 )
 
-# ------------------ Global In-Memory Queue & Results ------------------
-resume_scoring_queue = asyncio.Queue()
-resume_results = {}  # Maps job_id to result
+# ------------------ Global Scoring Concurrency Limit ------------------
+scoring_semaphore = asyncio.Semaphore(SCORING_CONCURRENCY)
+
+# ------------------ Global Job ID Counter ------------------
+# Job IDs never leave the process, so a counter is enough; no need for uuid4's urandom call.
+job_counter = itertools.count()
+
+# ------------------ Global Criteria Cache ------------------
+# Maps job description text hash to extracted criteria. Bounded in size and age so a
+# long-running process doesn't grow without limit.
+criteria_cache: TTLCache = TTLCache(maxsize=1024, ttl=3600)
+
+def criteria_cache_key(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+# Bounds how many uploads are held in memory at once, however many files a request sends.
+upload_semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+# PyMuPDF is not thread-safe, so PDF parses on the thread pool take turns.
+pdf_lock = threading.Lock()
 
 # ------------------ Helper Functions: File Text Extraction ------------------
 def extract_text_pdf(file_bytes: bytes) -> str:
     try:
-        reader = PyPDF2.PdfReader(io.BytesIO(file_bytes))
-        text = ""
-        for page in reader.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text += page_text + "\n"
+        parts = []
+        with pdf_lock, pymupdf.open(stream=file_bytes, filetype="pdf") as doc:
+            for i in range(doc.page_count):
+                page_text = doc[i].get_text("text")
+                if page_text:
+                    parts.append(page_text)
+        text = "\n".join(parts)
         logger.info("Extracted text from PDF successfully.")
         return text
     except Exception as e:
@@ -59,25 +128,64 @@ def extract_text_docx(file_bytes: bytes) -> str:
         logger.error(f"DOCX extraction error: {e}")
         raise HTTPException(status_code=400, detail=f"Error processing DOCX: {e}")
 
-def extract_text(file: UploadFile) -> str:
-    contents = file.file.read()
-    if file.filename.lower().endswith(".pdf"):
-        return extract_text_pdf(contents)
-    elif file.filename.lower().endswith((".docx", ".doc")):
-        return extract_text_docx(contents)
-    else:
+async def extract_text(file: UploadFile) -> str:
+    # Parsing is blocking, so it runs on the default thread pool to keep the event loop free.
+    ext = os.path.splitext(file.filename)[1].lower()
+    if ext not in (".pdf", ".docx", ".doc"):
         logger.error("Unsupported file type.")
         raise HTTPException(status_code=400, detail="Unsupported file type")
+    async with upload_semaphore:
+        # Reading one byte past the limit is enough to detect oversized uploads without loading them whole.
+        contents = await file.read(MAX_UPLOAD_BYTES + 1)
+        if len(contents) > MAX_UPLOAD_BYTES:
+            logger.error(f"Upload too large: {file.filename}")
+            raise HTTPException(status_code=413, detail=f"File exceeds {MAX_UPLOAD_BYTES // (1024 * 1024)} MB limit: {file.filename}")
+        if ext == ".pdf":
+            return await asyncio.to_thread(extract_text_pdf, contents)
+        return await asyncio.to_thread(extract_text_docx, contents)
+
+# ------------------ OpenAI REST Helpers ------------------
+def retry_delay(attempt: int, retry_after: str | None) -> float:
+    # Honor the server's Retry-After when given, otherwise exponential backoff with jitter.
+    if retry_after:
+        try:
+            return min(float(retry_after), RETRY_WAIT_MAX)
+        except ValueError:
+            pass  # HTTP-date form; fall back to backoff
+    return random.uniform(RETRY_WAIT_MIN, min(RETRY_WAIT_MAX, RETRY_WAIT_MIN * 2 ** attempt))
+
+async def post_chat_completion(client: httpx.AsyncClient, payload: dict) -> httpx.Response:
+    # Serialise with orjson rather than letting httpx use the stdlib json encoder.
+    body = orjson.dumps(payload)
+    headers = {"Content-Type": "application/json"}
+    if OPENAI_GZIP_REQUESTS:
+        # Level 1: resume text compresses well even at the cheapest setting.
+        body = gzip.compress(body, compresslevel=1)
+        headers["Content-Encoding"] = "gzip"
+    # Rate limits (429), 5xx and network errors are retried; the final attempt's outcome is returned/raised.
+    for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
+        try:
+            response = await client.post(
+                "/v1/chat/completions",
+                content=body,
+                headers=headers
+            )
+        except httpx.TransportError as e:
+            if attempt == RETRY_MAX_ATTEMPTS:
+                raise
+            reason, retry_after = repr(e), None
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or attempt == RETRY_MAX_ATTEMPTS:
+                return response
+            reason, retry_after = f"status {response.status_code}", response.headers.get("Retry-After")
+        delay = retry_delay(attempt, retry_after)
+        logger.warning(f"OpenAI request failed ({reason}), retrying in {delay:.1f}s (attempt {attempt}/{RETRY_MAX_ATTEMPTS}).")
+        await asyncio.sleep(delay)
 
 # ------------------ OpenAI REST Call for Criteria Extraction ------------------
-async def get_ranking_criteria(text: str) -> list:
-    url = "https://api.openai.com/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json"
-    }
+async def get_ranking_criteria(client: httpx.AsyncClient, text: str) -> list:
     payload = {
-        "model": "gpt-4o",  # Adjust as needed.
+        "model": MODEL_CRITERIA,
         "messages": [
             {"role": "system", "content": "You are an HR expert. Extract ranking criteria from a job description."},
             {"role": "user", "content": (
@@ -92,8 +200,7 @@ async def get_ranking_criteria(text: str) -> list:
         "response_format": {"type": "json_object"}
     }
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(url, headers=headers, json=payload)
+        response = await post_chat_completion(client, payload)
         logger.info(f"OpenAI API response status: {response.status_code}")
     except Exception as e:
         logger.error(f"HTTP request error: {e}")
@@ -101,11 +208,11 @@ async def get_ranking_criteria(text: str) -> list:
     if response.status_code != 200:
         logger.error(f"OpenAI API error response: {response.text}")
         raise HTTPException(status_code=500, detail=f"Error calling OpenAI API: {response.text}")
-    data = response.json()
+    data = orjson.loads(response.content)
     try:
         content = data["choices"][0]["message"]["content"].strip()
         logger.info(f"Raw OpenAI response content: {content}")
-        criteria_data = json.loads(content)
+        criteria_data = orjson.loads(content)
         if "criteria" in criteria_data:
             return criteria_data["criteria"]
         else:
@@ -115,34 +222,61 @@ async def get_ranking_criteria(text: str) -> list:
         logger.error(f"Error parsing OpenAI response: {e}")
         raise HTTPException(status_code=500, detail=f"Error parsing response: {e}")
 
-# ------------------ OpenAI REST Call for Resume Scoring ------------------
-async def score_resume_via_openai(candidate_name: str, resume_text: str, criteria: list) -> dict:
-    url = "https://api.openai.com/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    prompt = (
-        "Score the following resume for the given criteria. For each criterion, assign a score from 0 to 5. "
+# ------------------ OpenAI Request/Response Format for Resume Scoring ------------------
+# Several resumes are scored in one request so the shared instructions and criteria
+# are sent (and billed) once per chunk rather than once per resume.
+def build_scoring_payload(jobs: list, criteria_json: str, model: str) -> dict:
+    candidates = "\n\n".join(
+        f"### Candidate {index}: {job['candidate_name']}\n{job['resume_text']}"
+        for index, job in enumerate(jobs, start=1)
+    )
+    # Everything that is identical across chunks goes first, in the system message, so
+    # OpenAI's automatic prompt caching can reuse the prefix for every chunk after the first.
+    instructions = (
+        "You are an HR expert who scores resumes based on given criteria. "
+        "Score each of the resumes provided by the user for the given criteria. For each criterion, assign a score from 0 to 5. "
         "Also, calculate the total score as the sum of individual scores.\n\n"
-        f"Candidate Name: {candidate_name}\n\n"
-        f"Resume Text:\n{resume_text}\n\n"
-        f"Criteria: {json.dumps(criteria)}\n\n"
-        "Return your answer as a JSON object with a key 'scores' that maps each criterion to its score and includes a 'Total Score'."
+        "Return your answer as a JSON object with a key 'candidates' that maps each candidate number (\"1\", \"2\", ...) "
+        "to an object with a key 'scores' that maps each criterion to its score and includes a 'Total Score'.\n\n"
+        f"Criteria: {criteria_json}"
     )
-    payload = {
-        "model": "gpt-4o",  # Adjust as needed.
+    return {
+        "model": model,
         "messages": [
-            {"role": "system", "content": "You are an HR expert who scores resumes based on given criteria."},
-            {"role": "user", "content": prompt}
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": candidates}
         ],
         "temperature": 0.0,
-        "max_tokens": 2000,
+        "max_tokens": min(2000 * len(jobs), SCORING_MAX_TOKENS),
         "response_format": {"type": "json_object"}
     }
+
+def parse_scoring_response(data: dict, jobs: list) -> dict:
+    # Returns a dict mapping job_id to result; candidates missing from the reply are omitted,
+    # but a reply that scores none of them is an error.
+    try:
+        content = data["choices"][0]["message"]["content"].strip()
+        logger.info(f"Raw OpenAI scoring response content: {content}")
+        candidates = orjson.loads(content)["candidates"]
+    except Exception as e:
+        logger.error(f"Error parsing OpenAI scoring response: {e}")
+        raise Exception(f"Error parsing response: {e}")
+    results = {}
+    for index, job in enumerate(jobs, start=1):
+        result = candidates.get(str(index))
+        if isinstance(result, dict) and "scores" in result:
+            results[job["job_id"]] = result
+        else:
+            logger.error(f"Missing scores for job {job['job_id']} in OpenAI response.")
+    if not results:
+        raise Exception("Error parsing response: no candidate scores found")
+    return results
+
+# ------------------ OpenAI REST Call for Resume Scoring ------------------
+async def score_resumes_via_openai(client: httpx.AsyncClient, jobs: list, criteria_json: str, model: str) -> dict:
+    payload = build_scoring_payload(jobs, criteria_json, model)
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(url, headers=headers, json=payload)
+        response = await post_chat_completion(client, payload)
         logger.info(f"OpenAI API (scoring) response status: {response.status_code}")
     except Exception as e:
         logger.error(f"HTTP request error (scoring): {e}")
@@ -150,122 +284,280 @@ async def score_resume_via_openai(candidate_name: str, resume_text: str, criteri
     if response.status_code != 200:
         logger.error(f"OpenAI API error (scoring): {response.text}")
         raise Exception(f"Error calling OpenAI API: {response.text}")
-    data = response.json()
+    return parse_scoring_response(orjson.loads(response.content), jobs)
+
+# ------------------ OpenAI Batch API for Resume Scoring ------------------
+async def first_batch_error(client: httpx.AsyncClient, error_file_id: str | None) -> str:
+    # Best effort: returns the first line of the batch error file, for surfacing to the caller.
+    if not error_file_id:
+        return "unknown"
     try:
-        content = data["choices"][0]["message"]["content"].strip()
-        logger.info(f"Raw OpenAI scoring response content: {content}")
-        scores_data = json.loads(content)
-        if "scores" in scores_data:
-            return scores_data
-        else:
-            raise ValueError("Missing 'scores' key in response")
+        response = await client.get(f"/v1/files/{error_file_id}/content")
+        if response.status_code != 200:
+            raise Exception(response.text)
+        item = orjson.loads(response.content.splitlines()[0])
+        return str(item.get("error") or item["response"]["body"])
     except Exception as e:
-        logger.error(f"Error parsing OpenAI scoring response: {e}")
-        raise Exception(f"Error parsing response: {e}")
+        logger.error(f"Error downloading OpenAI batch error file: {e}")
+        return "unknown"
+
+async def score_resumes_via_batch(client: httpx.AsyncClient, chunks: list, criteria_json: str, model: str) -> dict:
+    # Returns a dict mapping job_id to result; jobs that failed inside the batch are omitted.
+    jsonl = b"\n".join(
+        orjson.dumps({
+            "custom_id": f"chunk-{index}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_scoring_payload(chunk, criteria_json, model)
+        })
+        for index, chunk in enumerate(chunks)
+    )
+    try:
+        response = await client.post(
+            "/v1/files",
+            data={"purpose": "batch"},
+            files={"file": ("resume_scoring.jsonl", jsonl, "application/jsonl")}
+        )
+        if response.status_code != 200:
+            raise Exception(response.text)
+        input_file_id = orjson.loads(response.content)["id"]
+        response = await client.post("/v1/batches", json={
+            "input_file_id": input_file_id,
+            "endpoint": "/v1/chat/completions",
+            "completion_window": "24h"
+        })
+        if response.status_code != 200:
+            raise Exception(response.text)
+        batch = orjson.loads(response.content)
+        logger.info(f"OpenAI batch {batch['id']} created for {len(chunks)} chunks.")
+    except Exception as e:
+        logger.error(f"Error creating OpenAI batch: {e}")
+        raise HTTPException(status_code=500, detail=f"Error creating OpenAI batch: {e}")
+
+    # Poll with exponential backoff until the batch reaches a terminal state.
+    delay = BATCH_POLL_INITIAL
+    deadline = time.monotonic() + BATCH_TIMEOUT
+    while batch["status"] not in ("completed", "failed", "expired", "cancelled"):
+        if time.monotonic() > deadline:
+            logger.error(f"Timeout waiting for OpenAI batch {batch['id']}, cancelling it.")
+            try:
+                await client.post(f"/v1/batches/{batch['id']}/cancel")
+            except Exception as e:
+                logger.error(f"Error cancelling OpenAI batch {batch['id']}: {e}")
+            raise HTTPException(status_code=504, detail="Timeout waiting for OpenAI batch results")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, BATCH_POLL_MAX)
+        try:
+            response = await client.get(f"/v1/batches/{batch['id']}")
+        except Exception as e:
+            logger.error(f"HTTP request error (batch status): {e}")
+            continue
+        if response.status_code != 200:
+            logger.error(f"OpenAI API error (batch status): {response.text}")
+            continue
+        batch = orjson.loads(response.content)
+        logger.info(f"OpenAI batch {batch['id']} status: {batch['status']}")
+
+    if batch["status"] != "completed":
+        logger.error(f"OpenAI batch {batch['id']} ended with status {batch['status']}.")
+        raise HTTPException(status_code=500, detail=f"OpenAI batch ended with status {batch['status']}")
+    if not batch.get("output_file_id"):
+        # OpenAI leaves output_file_id empty when every request failed; the errors are in error_file_id.
+        first_error = await first_batch_error(client, batch.get("error_file_id"))
+        logger.error(f"OpenAI batch {batch['id']} produced no output. First error: {first_error}")
+        raise HTTPException(status_code=500, detail=f"OpenAI batch produced no output. First error: {first_error}")
+
+    try:
+        response = await client.get(f"/v1/files/{batch['output_file_id']}/content")
+        if response.status_code != 200:
+            raise Exception(response.text)
+    except Exception as e:
+        logger.error(f"Error downloading OpenAI batch output: {e}")
+        raise HTTPException(status_code=500, detail=f"Error downloading OpenAI batch output: {e}")
+    results = {}
+    # Parse the output file as raw bytes; orjson takes bytes directly, so it is never decoded to str.
+    for line in response.content.splitlines():
+        if not line.strip():
+            continue
+        item = {}
+        try:
+            item = orjson.loads(line)
+            if item["response"]["status_code"] != 200:
+                raise Exception(f"Error calling OpenAI API: {item['response']['body']}")
+            chunk = chunks[int(item["custom_id"].removeprefix("chunk-"))]
+            results.update(parse_scoring_response(item["response"]["body"], chunk))
+        except Exception as e:
+            logger.error(f"Error processing {item.get('custom_id')}: {e}")
+    if not results:
+        logger.error(f"OpenAI batch {batch['id']} returned no usable scores.")
+        raise HTTPException(status_code=500, detail="OpenAI batch returned no usable scores")
+    return results
 
 # ------------------ Helper for Candidate Name ------------------
 def extract_candidate_name(file: UploadFile) -> str:
-    print(file.filename,"file",file.filename.rsplit(".", 1)[0])
-    return file.filename.rsplit(".", 1)[0]
-
-# ------------------ Background Worker ------------------
-async def resume_worker():
-    logger.info("Background worker started for resume scoring.")
-    while True:
-        job = await resume_scoring_queue.get()
+    return os.path.splitext(file.filename)[0]
+
+# ------------------ Concurrent Scoring ------------------
+async def score_chunk(client: httpx.AsyncClient, chunk: list, criteria_json: str, model: str) -> tuple:
+    # Returns (chunk, results, error) so callers consuming tasks out of order know which
+    # jobs finished and whether the call failed.
+    async with scoring_semaphore:
+        job_ids = [job["job_id"] for job in chunk]
+        logger.info(f"Processing jobs: {job_ids}")
         try:
-            logger.info(f"Processing job: {job}")
-            result = await score_resume_via_openai(
-                job["candidate_name"],
-                job["resume_text"],
-                job["criteria"]
-            )
-            # Store result using job_id as key.
-            print(result,"resulttt",job["job_id"])
-            resume_results[job["job_id"]] = result
-            resume_results[job["job_id"]]["candidate_name"] = job["candidate_name"]
-            logger.info(f"Job {job['job_id']} processed. Result: {result}")
+            results = await score_resumes_via_openai(client, chunk, criteria_json, model)
+            logger.info(f"Jobs {job_ids} processed. Results: {results}")
+            return chunk, results, None
         except Exception as e:
-            logger.error(f"Error processing job {job.get('job_id')}: {e}")
-        resume_scoring_queue.task_done()
+            logger.error(f"Error processing jobs {job_ids}: {e}")
+            return chunk, {}, e
 
-# ------------------ Global In-Memory Queue & Results ------------------
-resume_scoring_queue = asyncio.Queue()
-resume_results = {}  # Maps job_id to result
+# ------------------ CSV Helpers ------------------
+def csv_line(row: list) -> str:
+    output = io.StringIO()
+    csv.writer(output).writerow(row)
+    return output.getvalue()
 
-# ------------------ Startup Event ------------------
-@app.on_event("startup")
-async def startup_event():
-    # Start the background worker
-    asyncio.create_task(resume_worker())
+def result_csv_line(job: dict, res: dict, criteria: list) -> str:
+    # Jobs with no result (failed or timed out) get empty score cells, so they can't be
+    # mistaken for candidates who genuinely scored zero.
+    if not res:
+        return csv_line([job["candidate_name"]] + [""] * (len(criteria) + 1))
+    scores = res.get("scores", {})
+    return csv_line([job["candidate_name"]] + [scores.get(crit, 0) for crit in criteria] + [res.get("Total Score", 0)])
 
 # ------------------ API Endpoints ------------------
 
 @app.post("/extract-criteria", response_class=JSONResponse, summary="Extract Ranking Criteria")
-async def extract_criteria_endpoint(file: UploadFile = File(...)):
+async def extract_criteria_endpoint(response: Response, file: UploadFile = File(...)):
     logger.info("Received /extract-criteria request.")
-    text = extract_text(file)
-    criteria = await get_ranking_criteria(text)
+    text = await extract_text(file)
+    # Re-uploads of the same job description are answered without calling OpenAI.
+    cache_key = criteria_cache_key(text)
+    criteria = criteria_cache.get(cache_key)
+    if criteria is not None:
+        logger.info(f"Criteria cache hit: {cache_key}")
+        response.headers["X-Cache"] = "HIT"
+    else:
+        criteria = await get_ranking_criteria(app.state.http_client, text)
+        criteria_cache[cache_key] = criteria
+        response.headers["X-Cache"] = "MISS"
     logger.info(f"Extracted criteria: {criteria}")
     return {"criteria": criteria}
 
-@app.post("/score-resumes", summary="Enqueue Resume Scoring Jobs and Return CSV Results")
+@app.post("/score-resumes", summary="Score Resumes Concurrently and Return CSV Results")
 async def score_resumes_endpoint(
     criteria: str = Form(...),
-    files: list[UploadFile] = File(...)
+    files: list[UploadFile] = File(...),
+    batch: bool = Form(False),
+    precision: bool = Form(False)
 ):
     logger.info("Received /score-resumes request.")
     try:
-        criteria_list = json.loads(criteria)
+        criteria_list = orjson.loads(criteria)
         if not isinstance(criteria_list, list):
             raise ValueError("Criteria must be a list of strings.")
     except Exception as e:
         logger.error(f"Criteria parsing error: {e}")
         raise HTTPException(status_code=400, detail=f"Invalid criteria format: {e}")
     
-    job_ids = []
-    for file in files:
-        resume_text = extract_text(file)
+    # Parse uploads off the event loop, at most UPLOAD_CONCURRENCY at once; PDFs one at a time (see pdf_lock).
+    resume_texts = await asyncio.gather(*(extract_text(file) for file in files))
+    jobs = []
+    for file, resume_text in zip(files, resume_texts):
         candidate_name = extract_candidate_name(file)
-        job_id = str(uuid.uuid4())
+        job_id = f"j{next(job_counter)}"
         job_data = {
             "job_id": job_id,
-            "job_type": "score_resume",
             "candidate_name": candidate_name,
-            "resume_text": resume_text,
-            "criteria": criteria_list
+            "resume_text": resume_text
         }
-        print(job_data,"job_data")
-        await resume_scoring_queue.put(job_data)
-        job_ids.append(job_id)
-        logger.info(f"Job enqueued with id: {job_id}")
+        jobs.append(job_data)
+        logger.info(f"Job created with id: {job_id}")
     
-    # Wait until all jobs are processed by the background worker.
-    timeout = 90  # seconds
-    start_time = time.time()
-    while any(job_id not in resume_results for job_id in job_ids):
-        await asyncio.sleep(0.5)
-        if time.time() - start_time > timeout:
-            logger.error("Timeout waiting for resume scoring results.")
-            raise HTTPException(status_code=504, detail="Timeout waiting for resume scoring results")
-    
-    # Generate CSV from the results.
-    output = io.StringIO()
-    writer = csv.writer(output)
+    model = MODEL_SCORE_PRECISE if precision else MODEL_SCORE
+    # Serialised once per request; every chunk's prompt embeds the same string.
+    criteria_json = orjson.dumps(criteria_list).decode()
+    chunks = [jobs[i:i + SCORING_CHUNK_SIZE] for i in range(0, len(jobs), SCORING_CHUNK_SIZE)]
     header = ["Candidate Name"] + criteria_list + ["Total Score"]
-    writer.writerow(header)
-    for job_id in job_ids:
-        res = resume_results.get(job_id, {})
-        print(res,"result")
-        candidate = res.get("candidate_name", "Unknown")
-        scores = res.get("scores", {})
-        row = [candidate] + [scores.get(crit, 0) for crit in criteria_list] + [res.get("Total Score", 0)]
-        writer.writerow(row)
-    output.seek(0)
-    logger.info("CSV file generated, sending response.")
+    background = None
+    if batch:
+        # Half-price OpenAI Batch API; slower, suited to large submissions.
+        job_results = await score_resumes_via_batch(app.state.http_client, chunks, criteria_json, model)
+
+        async def rows():
+            yield csv_line(header)
+            for job in jobs:
+                yield result_csv_line(job, job_results.get(job["job_id"], {}), criteria_list)
+    else:
+        # Score all chunks concurrently; the semaphore caps how many calls are in flight.
+        tasks = [asyncio.create_task(score_chunk(app.state.http_client, chunk, criteria_json, model)) for chunk in chunks]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SCORING_TIMEOUT
+
+        # Async so Starlette runs it on the event loop; Task.cancel() is not thread-safe.
+        async def cancel_tasks():
+            for task in tasks:
+                task.cancel()
+
+        # Hold the response until a chunk scores successfully, so a bad API key or an OpenAI
+        # outage surfaces as an error status rather than a 200 CSV with nothing scored.
+        finished = []
+        pending = set(tasks)
+        try:
+            while pending and not any(task.result()[2] is None for task in finished):
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0, deadline - loop.time()), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    break
+                finished.extend(done)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        if not any(task.result()[2] is None for task in finished):
+            for task in tasks:
+                task.cancel()
+            if pending:
+                logger.error("Timeout waiting for resume scoring results.")
+                raise HTTPException(status_code=504, detail="Timeout waiting for resume scoring results")
+            logger.error("Every resume scoring call failed.")
+            raise HTTPException(status_code=502, detail=f"Error scoring resumes: {finished[0].result()[2]}")
+
+        # Stream the rows scored so far, then each remaining chunk's rows as soon as it is
+        # scored. Chunks still running at the deadline are cancelled and written as unscored rows.
+        async def rows():
+            yield csv_line(header)
+            written = set()
+            try:
+                for task in finished:
+                    chunk, results, _ = task.result()
+                    for job in chunk:
+                        yield result_csv_line(job, results.get(job["job_id"], {}), criteria_list)
+                        written.add(job["job_id"])
+                for next_done in asyncio.as_completed(pending, timeout=max(0, deadline - loop.time())):
+                    chunk, results, _ = await next_done
+                    for job in chunk:
+                        yield result_csv_line(job, results.get(job["job_id"], {}), criteria_list)
+                        written.add(job["job_id"])
+            except asyncio.TimeoutError:
+                logger.error("Timeout waiting for resume scoring results.")
+                for job in jobs:
+                    if job["job_id"] not in written:
+                        yield result_csv_line(job, {}, criteria_list)
+            finally:
+                for task in tasks:
+                    task.cancel()
+            logger.info("CSV file generated.")
+
+        # Also cancel from a background task, for responses that finish without the generator's
+        # finally running. Not a guarantee: under ASGI spec >= 2.4 Starlette skips background
+        # tasks on client disconnect.
+        background = BackgroundTask(cancel_tasks)
+
     headers_resp = {"Content-Disposition": "attachment; filename=resumes_scores.csv"}
-    return StreamingResponse(output, media_type="text/csv", headers=headers_resp)
+    return StreamingResponse(rows(), media_type="text/csv", headers=headers_resp, background=background)
 
 if __name__ == "__main__":
-    import uuid  # Ensure uuid is imported
     uvicorn.run(app, host="0.0.0.0", port=8000)